@@ -1,49 +1,176 @@
+import base64
+import hashlib
+import hmac
+import logging
 import os
+import tempfile
+import time
 from io import BytesIO
-from threading import Thread
-from typing import Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from threading import BoundedSemaphore, Lock, Thread
+from typing import Dict, Any, List, Tuple
 
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 from dotenv import load_dotenv
+from cachetools import TTLCache
+from PIL import Image, ImageOps
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---- LINE v3 SDK ----
-from linebot.v3.webhook import WebhookParser
-from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import Event, MessageEvent, TextMessageContent, ImageMessageContent
 from linebot.v3.messaging import (
     Configuration, ApiClient, MessagingApi, MessagingApiBlob,
-    ReplyMessageRequest, PushMessageRequest, TextMessage
+    ReplyMessageRequest, PushMessageRequest, ShowLoadingAnimationRequest, TextMessage
 )
 
 load_dotenv()
 
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="[%(levelname)s] %(threadName)s %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "")
 CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
 ANALYZER_URL = os.getenv("ANALYZER_URL", "https://ai-body-check-analyzer.onrender.com/analyze")
+ANALYZER_HEALTHZ_URL = ANALYZER_URL.replace("/analyze", "/healthz")
+# 最後の解析成功からこの秒数を超えたら、解析前に healthz でサーバを起こす
+ANALYZER_WARMUP_IDLE_SEC = 120
+# >0 ならこの間隔で healthz を叩き続けて analyzer を起こしておく（0 で無効）
+ANALYZER_KEEPALIVE_SEC = int(os.getenv("ANALYZER_KEEPALIVE_SEC", "0"))
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "512"))
+SESSION_TTL_SEC = int(os.getenv("SESSION_TTL_SEC", "900"))
+ANALYZE_WORKERS = int(os.getenv("ANALYZE_WORKERS", "4"))
+ANALYZE_MAX_PENDING = int(os.getenv("ANALYZE_MAX_PENDING", "16"))
+RESULT_CACHE_MAX = int(os.getenv("RESULT_CACHE_MAX", "256"))
+RESULT_CACHE_TTL_SEC = int(os.getenv("RESULT_CACHE_TTL_SEC", "3600"))
+
+# 解析中のローディング表示秒数（LINEの上限は60秒）と、結果を reply token で返せる期限
+# reply token は受信から約1分で失効するので余裕を持たせ、過ぎたら push で送る
+LOADING_SECONDS = 60
+REPLY_TOKEN_TTL_SEC = 50
+
+# analyzer へ送る画像の上限（長辺px）と再エンコード品質
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "960"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "75"))
+# これより小さいJPEGは縮めても転送量がほぼ変わらないので、デコードせずそのまま送る
+IMAGE_SHRINK_MIN_BYTES = 150 * 1024
+# side待ちのfront画像をメモリに置く上限。超えたら一時ファイルへ書き出す
+FRONT_SPOOL_MAX_BYTES = int(os.getenv("FRONT_SPOOL_MAX_BYTES", str(128 * 1024)))
 
 app = Flask(__name__)
 
 if not CHANNEL_SECRET or not CHANNEL_ACCESS_TOKEN:
-    print("[WARN] LINE env not set. Bot features will not work.")
+    logger.warning("LINE env not set. Bot features will not work.")
 
 # LINE clients
 config = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
 api_client = ApiClient(config)
 msg_api = MessagingApi(api_client)
 blob_api = MessagingApiBlob(api_client)
-parser = WebhookParser(CHANNEL_SECRET)
-
-# 次に期待する画像状態
-EXPECTING: Dict[str, str] = {}
+# 署名検証用。鍵パディング済みのHMAC状態を作っておき、リクエストごとにcopyする
+_SIGNATURE_HMAC = hmac.new(CHANNEL_SECRET.encode("utf-8"), digestmod=hashlib.sha256)
+
+# analyzer 用 HTTP セッション（keep-alive で TLS ハンドシェイクを使い回す）
+analyzer_session = requests.Session()
+# 解析スレッドごとに1本ずつ接続を持てるようプールを合わせる
+analyzer_session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=ANALYZE_WORKERS,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+))
+
+# 解析ジョブ用スレッドプール（webhook はすぐ返し、結果は push で送る）
+analyze_executor = ThreadPoolExecutor(max_workers=ANALYZE_WORKERS, thread_name_prefix="analyze")
+# 実行中＋待ちの解析数の上限。溢れたら受け付けずにユーザーへ再送を促す
+_analyze_slots = BoundedSemaphore(ANALYZE_MAX_PENDING)
+# 解析ジョブが実行中・待ちのユーザー。結果が届く前の二重投入は受け付けない
+_analyzing_users = set()
+
+# ユーザーごとの状態。更新は replace で新しいインスタンスに差し替えるので、
+# get_session の戻り値はコピーせずそのまま渡せる
+@dataclass(frozen=True, slots=True)
+class UserSession:
+    expecting: str | None = None  # 次に期待する画像（"front" / "side"）
+    front: Any = None             # 受信済みのfront画像（stash_image の戻り値）
+
+EMPTY_SESSION = UserSession()
+
+# 放置ユーザーで肥大化しないよう件数・期限つき。TTLCacheはスレッドセーフでないのでロックで守る
+SESSIONS: TTLCache = TTLCache(maxsize=SESSION_MAX_USERS, ttl=SESSION_TTL_SEC)
+_sessions_lock = Lock()
+
+def get_session(user_id: str) -> UserSession:
+    with _sessions_lock:
+        return SESSIONS.get(user_id, EMPTY_SESSION)
+
+def update_session(user_id: str, **fields):
+    # 書き戻すたびにTTLも延長される
+    with _sessions_lock:
+        SESSIONS[user_id] = replace(SESSIONS.get(user_id, EMPTY_SESSION), **fields)
+
+def clear_session(user_id: str):
+    with _sessions_lock:
+        SESSIONS.pop(user_id, None)
+
+# ユーザー単位の処理ロック。user_idのハッシュで64本に振り分け、別ユーザー同士はほぼ待たない
+USER_LOCK_SHARDS = 64
+_user_locks = tuple(Lock() for _ in range(USER_LOCK_SHARDS))
+
+def user_lock(user_id: str) -> Lock:
+    return _user_locks[hash(user_id) % USER_LOCK_SHARDS]
+
+# 解析結果キャッシュ（同じ画像の再送で analyzer を叩き直さない）
+# キーは送信する front/side 画像それぞれの sha256 を連結したもの
+RESULTS: TTLCache = TTLCache(maxsize=RESULT_CACHE_MAX, ttl=RESULT_CACHE_TTL_SEC)
+_results_lock = Lock()
+
+def result_cache_key(front_bytes: bytes, side_bytes: bytes) -> bytes:
+    return hashlib.sha256(front_bytes).digest() + hashlib.sha256(side_bytes).digest()
+
+def get_cached_result(key: bytes) -> Dict[str, Any] | None:
+    with _results_lock:
+        return RESULTS.get(key)
+
+def cache_result(key: bytes, result: Dict[str, Any]):
+    with _results_lock:
+        RESULTS[key] = result
+
+# ---------- 返信メッセージ ----------
+START_TEXT = "姿勢チェックを始めます。\n「front」と入力して正面写真→続けて「side」と入力して側面写真を送ってください。"
+FRONT_PROMPT_TEXT = "正面(front)の写真を送ってください。"
+SIDE_PROMPT_TEXT = "側面(side)の写真を送ってください。"
+HELP_TEXT = "使い方:\n1) 「開始」\n2) 「front」と入力→正面写真\n3) 「side」と入力→側面写真\n解析完了後に結果をお送りします。"
+NO_USER_ID_TEXT = "ユーザーIDの取得に失敗しました。もう一度お試しください。"
+NOT_STARTED_TEXT = "まず「開始」と入力し、その後「front」または「side」を入力してから画像を送ってください。"
+IMAGE_FETCH_FAILED_TEXT = "画像の取得に失敗しました。LINEから“画像として”送信してください（共有URL不可）。"
+FRONT_RECEIVED_TEXT = "front を受け取りました。次に「side」と入力→側面の写真を送ってください。"
+FRONT_MISSING_TEXT = "front画像が未取得です。先に「front」と入力→正面写真を送ってください。"
+ALREADY_ANALYZING_TEXT = "前回の解析がまだ終わっていません。結果が届いてから、もう一度側面の写真を送ってください。"
+BUSY_TEXT = "ただいま解析が混み合っています。少し時間をおいて、もう一度側面の写真を送ってください。"
+ANALYZE_STARTED_TEXT = "解析を開始しました。完了次第、結果をお送りします。"
+ANALYZE_FAILED_TEXT = "解析に失敗しました。時間をおいて再試行してください。"
+ANALYZER_TIMEOUT_TEXT = "解析サーバが混み合っています。時間をおいて再試行してください。"
+FORMAT_FAILED_TEXT = "解析結果の整形に失敗しました。もう一度お試しください。"
 
 # ---------- health ----------
+# 監視から頻繁に叩かれるので、レスポンスは起動時に作って使い回す
+INDEX_RESPONSE = Response("LINE Bot is running. Health: /healthz", status=200)
+HEALTHZ_RESPONSE = Response("ok", status=200, mimetype="text/plain")
+
 @app.get("/")
 def index():
-    return "LINE Bot is running. Health: /healthz", 200
+    return INDEX_RESPONSE
 
 @app.route("/healthz", methods=["GET", "HEAD"])
 def healthz():
-    return "ok", 200
+    return HEALTHZ_RESPONSE
 
 # ---------- 日本語整形 ----------
 def _fmt_deg(v):
@@ -64,59 +191,65 @@ def _fmt_cm(v):
     except Exception:
         return str(v)
 
+# (analyzerのキー, 表示名)。表示順もこの順
+SCORE_LABELS: Tuple[Tuple[str, str], ...] = (
+    ("balance", "バランス"),
+    ("fashion", "ファッション映え度"),
+    ("muscle_fat", "筋肉・脂肪のつき方"),
+    ("overall", "全体印象"),
+    ("posture", "姿勢"),
+)
+
 def format_analyzer_result_jp(result: Dict[str, Any]) -> str:
+    # 全セクションを1つのリストに積み、最後に1回だけjoinする（セクション間は空行）
+    out: List[str] = []
+
     scores = result.get("scores", {}) or {}
-    jp_scores = {
-        "バランス": scores.get("balance"),
-        "ファッション映え度": scores.get("fashion"),
-        "筋肉・脂肪のつき方": scores.get("muscle_fat"),
-        "全体印象": scores.get("overall"),
-        "姿勢": scores.get("posture"),
-    }
-    score_lines: List[str] = []
-    for k, v in jp_scores.items():
+    for key, label in SCORE_LABELS:
+        v = scores.get(key)
         if v is not None:
+            if not out:
+                out.append("【スコア】")
             try:
-                v_num = float(v)
-                score_lines.append(f"- {k}：{v_num:.1f}")
+                out.append(f"- {label}：{float(v):.1f}")
             except Exception:
-                score_lines.append(f"- {k}：{v}")
+                out.append(f"- {label}：{v}")
 
     front = result.get("front_metrics", {}) or {}
     pelvis = front.get("pelvis_tilt")
     shoulder = front.get("shoulder_angle")
-    front_lines = []
-    if pelvis is not None:
-        front_lines.append(f"- 骨盤の傾き：{_fmt_deg(pelvis)}")
-    if shoulder is not None:
-        front_lines.append(f"- 肩の角度差：{_fmt_deg(shoulder)}")
+    if pelvis is not None or shoulder is not None:
+        if out:
+            out.append("")
+        out.append("【正面評価】")
+        if pelvis is not None:
+            out.append(f"- 骨盤の傾き：{_fmt_deg(pelvis)}")
+        if shoulder is not None:
+            out.append(f"- 肩の角度差：{_fmt_deg(shoulder)}")
 
     side = result.get("side_metrics", {}) or {}
     fwd_head = side.get("forward_head")
     kyphosis = side.get("kyphosis")
-    side_lines = []
-    if fwd_head is not None:
-        side_lines.append(f"- 頭の前方変位：{_fmt_cm(fwd_head)}")
-    if kyphosis is not None:
-        side_lines.append(f"- 背中の丸まり（胸椎後弯）：{kyphosis}")
-
-    adv = result.get("advice", []) or []
-    adv_lines = [f"- {a}" for a in adv if a]
-
-    parts = []
-    if score_lines:
-        parts.append("【スコア】\n" + "\n".join(score_lines))
-    if front_lines:
-        parts.append("【正面評価】\n" + "\n".join(front_lines))
-    if side_lines:
-        parts.append("【側面評価】\n" + "\n".join(side_lines))
+    if fwd_head is not None or kyphosis is not None:
+        if out:
+            out.append("")
+        out.append("【側面評価】")
+        if fwd_head is not None:
+            out.append(f"- 頭の前方変位：{_fmt_cm(fwd_head)}")
+        if kyphosis is not None:
+            out.append(f"- 背中の丸まり（胸椎後弯）：{kyphosis}")
+
+    adv_lines = [f"- {a}" for a in (result.get("advice", []) or []) if a]
     if adv_lines:
-        parts.append("【アドバイス】\n" + "\n".join(adv_lines))
+        if out:
+            out.append("")
+        out.append("【アドバイス】")
+        out += adv_lines
 
-    if not parts:
-        return "解析結果の整形に失敗しました。もう一度お試しください。"
+    if not out:
+        return FORMAT_FAILED_TEXT
 
-    return "\n\n".join(parts)
+    return "\n".join(out)
 
 # ---------- analyzer 呼び出し ----------
 def post_to_analyzer(front_bytes: bytes | None, side_bytes: bytes | None, timeout=(5, 55)) -> Dict[str, Any]:
@@ -125,9 +258,9 @@ def post_to_analyzer(front_bytes: bytes | None, side_bytes: bytes | None, timeou
         files["front"] = ("front.jpg", front_bytes, "image/jpeg")
     if side_bytes:
         files["side"] = ("side.jpg", side_bytes, "image/jpeg")
-    resp = requests.post(ANALYZER_URL, files=files, timeout=timeout)
+    resp = analyzer_session.post(ANALYZER_URL, files=files, timeout=timeout)
     resp.raise_for_status()
-    return resp.json()
+    return orjson.loads(resp.content)
 
 def get_image_bytes(message_id: str) -> bytes:
     # v3はbytesが返る実装。将来の変更に備えて念のため両対応
@@ -144,131 +277,305 @@ def get_image_bytes(message_id: str) -> bytes:
         return content.read()
     raise TypeError(f"Unsupported blob content: {type(content)}")
 
+def shrink_image(img_bytes: bytes) -> bytes:
+    # スマホ写真をそのまま送ると転送が支配的になるので、長辺を縮めてJPEGで再エンコード
+    if len(img_bytes) < IMAGE_SHRINK_MIN_BYTES and img_bytes[:2] == b"\xff\xd8":
+        return img_bytes
+    try:
+        with Image.open(BytesIO(img_bytes)) as img:
+            if img.format == "JPEG" and max(img.size) <= IMAGE_MAX_SIDE:
+                return img_bytes
+            # JPEGはDCTスケーリングで縮小デコード（フル解像度を展開しない）
+            img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+            out = ImageOps.exif_transpose(img)
+        if out.mode not in ("RGB", "L"):
+            out = out.convert("RGB")
+        out.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+        buf = BytesIO()
+        out.save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        return buf.getvalue()
+    except Exception as e:
+        logger.warning("shrink failed, sending original: %s", e)
+        return img_bytes
+
+def stash_image(img_bytes: bytes):
+    # side待ちの間のfront画像置き場。縮小済みの小さい画像はメモリのまま持ち、
+    # 大きいものだけ名前なしの一時ファイルへ退避する（閉じられた時点でディスクからも消える）
+    f = tempfile.SpooledTemporaryFile(max_size=FRONT_SPOOL_MAX_BYTES, prefix="front_", suffix=".jpg")
+    f.write(img_bytes)
+    return f
+
+def load_stashed_image(f) -> bytes:
+    f.seek(0)
+    return f.read()
+
+def text_message(text: str) -> TextMessage:
+    # 中身は自前で組み立てた文字列なので pydantic の検証は省く（上限5000文字だけ守る）
+    return TextMessage.construct(text=text[:5000])
+
+# 定型文はメッセージのリストを起動時に作って使い回す（送信時にJSON化されるだけで書き換えない）
+FIXED_MESSAGES: Dict[str, List[TextMessage]] = {
+    t: [text_message(t)] for t in (
+        START_TEXT, FRONT_PROMPT_TEXT, SIDE_PROMPT_TEXT, HELP_TEXT, NO_USER_ID_TEXT,
+        NOT_STARTED_TEXT, IMAGE_FETCH_FAILED_TEXT, FRONT_RECEIVED_TEXT, FRONT_MISSING_TEXT,
+        ALREADY_ANALYZING_TEXT, BUSY_TEXT, ANALYZE_STARTED_TEXT, ANALYZE_FAILED_TEXT,
+        ANALYZER_TIMEOUT_TEXT, FORMAT_FAILED_TEXT,
+    )
+}
+
+def text_messages(text: str) -> List[TextMessage]:
+    return FIXED_MESSAGES.get(text) or [text_message(text)]
+
 def safe_reply(reply_token: str, text: str):
     try:
         msg_api.reply_message(
-            ReplyMessageRequest(
+            ReplyMessageRequest.construct(
                 reply_token=reply_token,
-                messages=[TextMessage(text=text[:5000])]
+                messages=text_messages(text)
             )
         )
     except Exception as e:
-        print(f"[WARN] reply failed: {e}")
+        logger.warning("reply failed: %s", e)
 
-def analyze_and_push(user_id: str, front_bytes: bytes, side_bytes: bytes):
-    # cold start対策（hibernation回避）
+def show_loading(user_id: str) -> bool:
     try:
-        healthz = ANALYZER_URL.replace("/analyze", "/healthz")
-        requests.get(healthz, timeout=2)
-    except Exception:
-        pass
-
-    out_text = "解析に失敗しました。時間をおいて再試行してください。"
+        msg_api.show_loading_animation(
+            ShowLoadingAnimationRequest.construct(
+                chat_id=user_id,
+                loading_seconds=LOADING_SECONDS
+            )
+        )
+        return True
+    except Exception as e:
+        logger.warning("loading animation failed: %s", e)
+        return False
+
+def reserve_analysis_slot() -> bool:
+    return _analyze_slots.acquire(blocking=False)
+
+def is_analyzing(user_id: str) -> bool:
+    return user_id in _analyzing_users
+
+def submit_analysis(user_id: str, front_bytes: bytes, side_bytes: bytes,
+                    reply_token: str | None = None, reply_deadline: float = 0.0):
+    # reserve_analysis_slot() で枠を確保してから呼ぶこと。枠はジョブ終了時に返す
+    _analyzing_users.add(user_id)
+    fut = analyze_executor.submit(
+        analyze_and_push, user_id, front_bytes, side_bytes, reply_token, reply_deadline
+    )
+
+    def _done(_):
+        _analyzing_users.discard(user_id)
+        _analyze_slots.release()
+
+    fut.add_done_callback(_done)
+
+# 直近の解析成功時刻（time.monotonic）
+_analyzer_last_ok = 0.0
+
+def analyze_and_push(user_id: str, front_bytes: bytes, side_bytes: bytes,
+                     reply_token: str | None = None, reply_deadline: float = 0.0):
+    global _analyzer_last_ok
+    key = result_cache_key(front_bytes, side_bytes)
+    result = get_cached_result(key)
+
+    # cold start対策（hibernation回避）。直近で成功していれば起きているので省く
+    if result is None and time.monotonic() - _analyzer_last_ok > ANALYZER_WARMUP_IDLE_SEC:
+        try:
+            analyzer_session.get(ANALYZER_HEALTHZ_URL, timeout=2)
+        except Exception:
+            pass
+
+    out_text = ANALYZE_FAILED_TEXT
     try:
-        result = post_to_analyzer(front_bytes, side_bytes)
+        if result is None:
+            result = post_to_analyzer(front_bytes, side_bytes)
+            _analyzer_last_ok = time.monotonic()
+            cache_result(key, result)
         out_text = format_analyzer_result_jp(result)
     except requests.Timeout:
-        out_text = "解析サーバが混み合っています。時間をおいて再試行してください。"
+        out_text = ANALYZER_TIMEOUT_TEXT
     except requests.RequestException as e:
-        print(f"[ERROR] analyzer request: {e}")
+        logger.error("analyzer request: %s", e)
     except Exception as e:
-        print(f"[ERROR] formatting: {e}")
+        logger.error("formatting: %s", e)
+
+    deliver_result(user_id, out_text, reply_token, reply_deadline)
+
+def deliver_result(user_id: str, text: str, reply_token: str | None, reply_deadline: float):
+    # 期限内なら画像を受けた時の reply token で返す（push は通数課金の対象になる）
+    if reply_token and time.monotonic() < reply_deadline:
+        try:
+            msg_api.reply_message(
+                ReplyMessageRequest.construct(
+                    reply_token=reply_token,
+                    messages=text_messages(text)
+                )
+            )
+            return
+        except Exception as e:
+            logger.warning("reply failed, falling back to push: %s", e)
 
     try:
         msg_api.push_message(
-            PushMessageRequest(
+            PushMessageRequest.construct(
                 to=user_id,
-                messages=[TextMessage(text=out_text[:5000])]
+                messages=text_messages(text)
             )
         )
     except Exception as e:
-        print(f"[ERROR] push failed: {e}")
+        logger.error("push failed: %s", e)
+
+def _keep_analyzer_warm():
+    global _analyzer_last_ok
+    while True:
+        try:
+            resp = analyzer_session.get(ANALYZER_HEALTHZ_URL, timeout=2)
+            if resp.ok:
+                # 起きているのが分かったので解析前の warm-up は省ける
+                _analyzer_last_ok = time.monotonic()
+        except Exception as e:
+            logger.debug("analyzer keepalive: %s", e)
+        time.sleep(ANALYZER_KEEPALIVE_SEC)
+
+if ANALYZER_KEEPALIVE_SEC > 0:
+    Thread(target=_keep_analyzer_warm, name="analyzer-keepalive", daemon=True).start()
 
 # ---------- webhook ----------
+SIGNATURE_LENGTH = 44
+HANDLED_MESSAGE_TYPES = frozenset(("text", "image"))
+
+# テキストコマンド -> (次に期待する画像, 返信)
+TEXT_COMMANDS: Dict[str, Tuple[str, str]] = {
+    "開始": ("front", START_TEXT),
+    "start": ("front", START_TEXT),
+    "かいし": ("front", START_TEXT),
+    "front": ("front", FRONT_PROMPT_TEXT),
+    "正面": ("front", FRONT_PROMPT_TEXT),
+    "side": ("side", SIDE_PROMPT_TEXT),
+    "側面": ("side", SIDE_PROMPT_TEXT),
+}
+
+def parse_webhook(body: bytes, signature: str) -> List[Event]:
+    # SDKのWebhookParserはstr前提なので、bytesのまま署名検証してorjsonでパースする
+    # 署名は base64(SHA256) = 44文字。形が違うものはHMACを計算する前に弾く
+    expected = None
+    if len(signature) == SIGNATURE_LENGTH:
+        try:
+            expected = base64.b64decode(signature, validate=True)
+        except ValueError:
+            pass
+    if expected is None:
+        raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+
+    mac = _SIGNATURE_HMAC.copy()
+    mac.update(body)
+    if not hmac.compare_digest(mac.digest(), expected):
+        raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+
+    events: List[Event] = []
+    for event in orjson.loads(body).get("events", []):
+        # 扱うのはテキスト・画像メッセージだけなので、それ以外はモデル化しない
+        if event.get("type") != "message":
+            continue
+        if (event.get("message") or {}).get("type") not in HANDLED_MESSAGE_TYPES:
+            continue
+        try:
+            events.append(Event.from_dict(event))
+        except ValueError as e:
+            logger.warning("event parse: %s", e)
+    return events
+
 @app.post("/callback")
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
-    body = request.get_data(as_text=True)
+    body = request.get_data(cache=False)
+    received_at = time.monotonic()
     try:
-        events = parser.parse(body, signature)
+        events = parse_webhook(body, signature)
     except Exception as e:
-        print(f"[ERROR] signature parse: {e}")
+        logger.error("signature parse: %s", e)
         abort(400)
 
     for ev in events:
         if not isinstance(ev, MessageEvent):
             continue
 
+        msg = ev.message
         reply_token = ev.reply_token
         user_id = getattr(ev.source, "user_id", None)
 
         # テキスト
-        if isinstance(ev.message, TextMessageContent):
-            text = (ev.message.text or "").strip().lower()
-            if text in ("開始", "start", "かいし"):
-                if user_id:
-                    EXPECTING[user_id] = "front"
-                safe_reply(reply_token, "姿勢チェックを始めます。\n「front」と入力して正面写真→続けて「side」と入力して側面写真を送ってください。")
-                continue
-            if text == "front":
-                if user_id:
-                    EXPECTING[user_id] = "front"
-                safe_reply(reply_token, "正面(front)の写真を送ってください。")
+        if isinstance(msg, TextMessageContent):
+            text = (msg.text or "").strip().lower()
+            cmd = TEXT_COMMANDS.get(text)
+            if cmd is None:
+                safe_reply(reply_token, HELP_TEXT)
                 continue
-            if text == "side":
-                if user_id:
-                    EXPECTING[user_id] = "side"
-                safe_reply(reply_token, "側面(side)の写真を送ってください。")
-                continue
-            safe_reply(reply_token, "使い方:\n1) 「開始」\n2) 「front」と入力→正面写真\n3) 「side」と入力→側面写真\n解析完了後に結果をお送りします。")
+            next_expecting, reply_text = cmd
+            if user_id:
+                with user_lock(user_id):
+                    update_session(user_id, expecting=next_expecting)
+            safe_reply(reply_token, reply_text)
             continue
 
         # 画像
-        if isinstance(ev.message, ImageMessageContent):
+        if isinstance(msg, ImageMessageContent):
             if not user_id:
-                safe_reply(reply_token, "ユーザーIDの取得に失敗しました。もう一度お試しください。")
-                continue
-            expecting = EXPECTING.get(user_id)
-            if expecting not in ("front", "side"):
-                safe_reply(reply_token, "まず「開始」と入力し、その後「front」または「side」を入力してから画像を送ってください。")
-                continue
-
-            try:
-                content_bytes = get_image_bytes(ev.message.id)
-            except Exception as e:
-                print(f"[ERROR] blob: {e}")
-                safe_reply(reply_token, "画像の取得に失敗しました。LINEから“画像として”送信してください（共有URL不可）。")
-                continue
-
-            k_front = f"{user_id}:front"
-            k_side  = f"{user_id}:side"
-
-            if expecting == "front":
-                app.config[k_front] = content_bytes
-                EXPECTING[user_id] = "side"
-                safe_reply(reply_token, "front を受け取りました。次に「side」と入力→側面の写真を送ってください。")
+                safe_reply(reply_token, NO_USER_ID_TEXT)
                 continue
+            # 同じユーザーのイベントは直列に処理する（front/sideの取り違えや二重解析を防ぐ）
+            with user_lock(user_id):
+                sess = get_session(user_id)
+                expecting = sess.expecting
+                if expecting not in ("front", "side"):
+                    safe_reply(reply_token, NOT_STARTED_TEXT)
+                    continue
 
-            if expecting == "side":
-                app.config[k_side] = content_bytes
-                front_bytes = app.config.get(k_front)
-                side_bytes  = app.config.get(k_side)
-                if not front_bytes:
-                    EXPECTING[user_id] = "front"
-                    safe_reply(reply_token, "front画像が未取得です。先に「front」と入力→正面写真を送ってください。")
+                try:
+                    content_bytes = shrink_image(get_image_bytes(msg.id))
+                except Exception as e:
+                    logger.error("blob: %s", e)
+                    safe_reply(reply_token, IMAGE_FETCH_FAILED_TEXT)
                     continue
 
-                safe_reply(reply_token, "解析を開始しました。完了次第、結果をお送りします。")
-                Thread(target=analyze_and_push, args=(user_id, front_bytes, side_bytes), daemon=True).start()
+                if expecting == "front":
+                    update_session(user_id, expecting="side", front=stash_image(content_bytes))
+                    safe_reply(reply_token, FRONT_RECEIVED_TEXT)
+                    continue
 
-                # 後始末
-                app.config.pop(k_front, None)
-                app.config.pop(k_side, None)
-                EXPECTING.pop(user_id, None)
-                continue
+                if expecting == "side":
+                    front_file = sess.front
+                    if front_file is None:
+                        update_session(user_id, expecting="front")
+                        safe_reply(reply_token, FRONT_MISSING_TEXT)
+                        continue
+
+                    # セッション（front画像・side待ち）は残すので、結果が届いた後にsideを送り直せる
+                    if is_analyzing(user_id):
+                        safe_reply(reply_token, ALREADY_ANALYZING_TEXT)
+                        continue
+
+                    if not reserve_analysis_slot():
+                        safe_reply(reply_token, BUSY_TEXT)
+                        continue
+
+                    # 受付メッセージの代わりにローディングを出し、結果をこの reply token で返す
+                    # ローディングが出せなければ従来どおり受付を返して結果は push
+                    if show_loading(user_id):
+                        submit_analysis(user_id, load_stashed_image(front_file), content_bytes,
+                                        reply_token, received_at + REPLY_TOKEN_TTL_SEC)
+                    else:
+                        safe_reply(reply_token, ANALYZE_STARTED_TEXT)
+                        submit_analysis(user_id, load_stashed_image(front_file), content_bytes)
+
+                    # 後始末
+                    clear_session(user_id)
+                    continue
 
     return "OK", 200
 
 if __name__ == "__main__":
+    # ローカル確認用。本番は Procfile の gunicorn で起動する
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=os.getenv("FLASK_DEBUG") == "1")